@@ -5,15 +5,17 @@ from __future__ import absolute_import, division, print_function
 
 __metaclass__ = type
 
+import functools
+import hashlib
 import os
 import re
+import secrets
 import stat
 import tempfile
-from distutils.version import LooseVersion
+from shlex import quote
 
-from ansible.module_utils._text import to_native, to_text
+from ansible.module_utils._text import to_bytes, to_native, to_text
 from ansible.module_utils.basic import AnsibleModule
-from six import b
 
 ANSIBLE_METADATA = {'metadata_version': '1.1',
                     'status': ['preview'],
@@ -62,6 +64,13 @@ options:
             - git commit staged changes. Same as "git commit -m".
         type: bool
         default: True
+    fast_commit:
+        description:
+            - when "add" lists only files, stage and commit them with git plumbing
+              (update-index, write-tree, commit-tree) instead of "git add" and "git commit".
+            - commit hooks are not run and commit.gpgSign is ignored.
+        type: bool
+        default: False
     push_option:
         description:
             - git push options. Same as "git --push-option=option".
@@ -72,6 +81,12 @@ options:
         choices: [ 'ssh', 'https' ]
         default: ssh
         required: True
+    accept_hostkey:
+        description:
+            - add "-o StrictHostKeyChecking=no" to the ssh options so an unknown
+              remote host key does not make the push hang or fail.
+        type: bool
+        default: False
     url:
         description:
             - git repo URL. If not provided, the module will use the same mode used by "git clone"
@@ -123,24 +138,22 @@ to_do:
     lorem ipsum
 '''
 
+COMMAND_SEPARATOR = '__SEP__'
 
-def get_module_path():
-    return os.path.dirname(os.path.realpath(__file__))
+ACTION_MAP = {
+    b'A': 'added',
+    b'D': 'deleted',
+    b'M': 'modified',
+}
 
+_GIT_BIN = None
 
-def write_ssh_wrapper():
-    module_dir = get_module_path()
-    try:
-        # make sure we have full permission to the module_dir, which
-        # may not be the case if we're sudo'ing to a non-root user
-        if os.access(module_dir, os.W_OK | os.R_OK | os.X_OK):
-            fd, wrapper_path = tempfile.mkstemp(prefix=module_dir + '/')
-        else:
-            raise OSError
-    except (IOError, OSError):
-        fd, wrapper_path = tempfile.mkstemp()
-    fh = os.fdopen(fd, 'w+b')
-    template = b("""#!/bin/sh
+_GIT_VERSION_RE = re.compile(r'git version (\d+)\.(\d+)(?:\.(\d+))?')
+
+_MODULE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+SSH_WRAPPER_TEMPLATE = b"""#!/bin/sh
 if [ -z "$GIT_SSH_OPTS" ]; then
     BASEOPTS=""
 else
@@ -150,13 +163,101 @@ fi
 # Let ssh fail rather than prompt
 BASEOPTS="$BASEOPTS -o BatchMode=yes"
 
+# Share one connection between consecutive ssh calls (e.g. fetch negotiation
+# and push). %C only covers user/host/port, so the key and extra options are
+# hashed into the socket name too: a connection is never reused with a
+# different identity. Without a usable socket directory, connect directly.
+CONTROL_DIR="$HOME/.ssh"
+if mkdir -p -m 700 "$CONTROL_DIR" 2>/dev/null && [ -w "$CONTROL_DIR" ]; then
+    CONTROL_ID=$(printf '%s\\n%s' "$GIT_KEY" "$GIT_SSH_OPTS" | cksum | cut -d ' ' -f 1)
+    set -- -o ControlMaster=auto -o ControlPersist=60s \\
+        -o "ControlPath=$CONTROL_DIR/ansible-%C-$CONTROL_ID" "$@"
+fi
+
 if [ -z "$GIT_KEY" ]; then
     ssh $BASEOPTS "$@"
 else
     ssh -i "$GIT_KEY" -o IdentitiesOnly=yes $BASEOPTS "$@"
 fi
-""")
-    fh.write(template)
+"""
+
+# The wrapper never changes between runs, so it is written once under a name
+# keyed on its content and shared by every later invocation.
+SSH_WRAPPER_NAME = 'ansible-git-ssh-{}.sh'.format(hashlib.sha256(SSH_WRAPPER_TEMPLATE).hexdigest()[:16])
+
+
+def shell_join(argv):
+    """return argv as a single shell command line with every argument quoted"""
+    return ' '.join(quote(arg) for arg in argv)
+
+
+def get_git_bin(module):
+    """return the git executable found on $PATH, resolving it only once"""
+    global _GIT_BIN
+    if _GIT_BIN is None:
+        _GIT_BIN = module.get_bin_path('git', True)
+    return _GIT_BIN
+
+
+def get_module_path():
+    return _MODULE_DIR
+
+
+def is_noexec(directory):
+    """return whether files in directory cannot be executed (noexec mount or missing)"""
+    try:
+        return bool(os.statvfs(directory).f_flag & getattr(os, 'ST_NOEXEC', 0))
+    except OSError:
+        return True
+
+
+def write_ssh_wrapper():
+    """return the ssh wrapper path and whether it is the shared copy"""
+    # Prefer the module dir like the per-run wrapper always did; the temp dir
+    # is only used for the shared copy when it is not mounted noexec.
+    for directory in (get_module_path(), tempfile.gettempdir()):
+        if is_noexec(directory):
+            continue
+        wrapper_path = os.path.join(directory, SSH_WRAPPER_NAME)
+        if write_shared_ssh_wrapper(wrapper_path):
+            return wrapper_path, True
+    return write_private_ssh_wrapper(), False
+
+
+def write_shared_ssh_wrapper(wrapper_path):
+    """create the shared wrapper at wrapper_path, return whether it is usable"""
+    try:
+        fd = os.open(wrapper_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o700)
+    except FileExistsError:
+        # Only reuse a complete wrapper that we own and nobody else can modify.
+        try:
+            st = os.lstat(wrapper_path)
+        except OSError:
+            # removed again (e.g. by a tmp cleaner) since the open above
+            return False
+        return (stat.S_ISREG(st.st_mode) and st.st_uid == os.getuid()
+                and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+                and st.st_size == len(SSH_WRAPPER_TEMPLATE))
+    except (IOError, OSError):
+        return False
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(SSH_WRAPPER_TEMPLATE)
+    return True
+
+
+def write_private_ssh_wrapper():
+    module_dir = get_module_path()
+    try:
+        # make sure we have full permission to the module_dir, which
+        # may not be the case if we're sudo'ing to a non-root user
+        if os.access(module_dir, os.W_OK | os.R_OK | os.X_OK):
+            fd, wrapper_path = tempfile.mkstemp(prefix=module_dir + '/')
+        else:
+            raise OSError
+    except (IOError, OSError):
+        fd, wrapper_path = tempfile.mkstemp()
+    fh = os.fdopen(fd, 'w+b')
+    fh.write(SSH_WRAPPER_TEMPLATE)
     fh.close()
     st = os.stat(wrapper_path)
     os.chmod(wrapper_path, st.st_mode | stat.S_IEXEC)
@@ -164,56 +265,53 @@ fi
 
 
 def set_git_ssh(ssh_wrapper, key_file, ssh_opts):
-    if os.environ.get("GIT_SSH"):
-        del os.environ["GIT_SSH"]
-    os.environ["GIT_SSH"] = ssh_wrapper
-
-    if os.environ.get("GIT_KEY"):
-        del os.environ["GIT_KEY"]
-
-    if key_file:
-        os.environ["GIT_KEY"] = key_file
-
-    if os.environ.get("GIT_SSH_OPTS"):
-        del os.environ["GIT_SSH_OPTS"]
-
-    if ssh_opts:
-        os.environ["GIT_SSH_OPTS"] = ssh_opts
+    """return the environment git needs to go through the ssh wrapper"""
+    # Empty values mask any GIT_KEY/GIT_SSH_OPTS inherited from the parent
+    # environment; the wrapper treats them as unset.
+    return {
+        "GIT_SSH": ssh_wrapper,
+        "GIT_KEY": key_file or "",
+        "GIT_SSH_OPTS": ssh_opts or "",
+    }
 
 
+@functools.lru_cache(maxsize=32)
 def get_repo_path(local_path):
     repo_path = os.path.join(local_path, '.git')
     # Check if the .git is a file. If it is a file, it means that the repository is in external
     # directory respective to the working copy (e.g. we are in a submodule structure).
-    if os.path.isfile(repo_path):
-        with open(repo_path, 'r') as gitfile:
-            data = gitfile.read()
-        ref_prefix, gitdir = data.rstrip().split('gitdir: ', 1)
-        if ref_prefix:
-            raise ValueError('.git file has invalid git dir reference format')
-
-        # There is a possibility the .git file to have an absolute path.
-        if os.path.isabs(gitdir):
-            repo_path = gitdir
-        else:
-            repo_path = os.path.join(repo_path.split('.git')[0], gitdir)
-        if not os.path.isdir(repo_path):
-            raise ValueError('%s is not a directory' % repo_path)
+    # A single stat answers that for the common case of a plain .git directory.
+    try:
+        st = os.stat(repo_path)
+    except OSError:
+        return repo_path
+    if not stat.S_ISREG(st.st_mode):
+        return repo_path
+
+    with open(repo_path, 'r') as gitfile:
+        data = gitfile.read()
+    ref_prefix, gitdir = data.rstrip().split('gitdir: ', 1)
+    if ref_prefix:
+        raise ValueError('.git file has invalid git dir reference format')
+
+    # The .git file may hold an absolute path, in which case join() returns it as is.
+    repo_path = os.path.join(os.path.dirname(repo_path), gitdir)
+    if not os.path.isdir(repo_path):
+        raise ValueError('%s is not a directory' % repo_path)
     return repo_path
 
 
 def git_version(git_path, module):
-    """return the installed version of git"""
-    cmd = "%s --version" % git_path
-    (rc, out, err) = module.run_command(cmd)
+    """return the installed version of git as a (major, minor, patch) tuple"""
+    (rc, out, err) = module.run_command([git_path, '--version'])
     if rc != 0:
         # one could fail_json here, but the version info is not that important,
         # so let's try to fail only on actual git commands
         return None
-    rematch = re.search('git version (.*)$', to_native(out))
+    rematch = _GIT_VERSION_RE.search(to_native(out))
     if not rematch:
         return None
-    return LooseVersion(rematch.groups()[0])
+    return tuple(int(part) for part in rematch.groups(default='0'))
 
 
 def main():
@@ -229,10 +327,12 @@ def main():
             push=dict(type="bool", default=True),
             set_upstream=dict(type="bool", default=False),
             commit=dict(type="bool", default=True),
+            fast_commit=dict(type="bool", default=False),
             push_option=dict(),
             mode=dict(choices=["ssh", "https"], default="ssh", required=True),
             key_file=dict(default=None, type='path', required=False),
             ssh_opts=dict(default=None, required=False),
+            accept_hostkey=dict(type='bool', default=False),
             executable=dict(default=None, type='path'),
         ),
         mutually_exclusive=[("ssh", "https")],
@@ -244,6 +344,11 @@ def main():
         supports_check_mode=True
     )
 
+    # We screenscrape a huge amount of git commands so use C locale anytime we
+    # call run_command()
+    module.run_command_environ_update = dict(LANG='C', LC_ALL='C', LC_MESSAGES='C',
+                                             LC_CTYPE='C')
+
     local_path = module.params['local_path']
     user = module.params['user']
     token = module.params['token']
@@ -254,18 +359,31 @@ def main():
     push = module.params['push']
     set_upstream = module.params['set_upstream']
     commit = module.params['commit']
+    fast_commit = module.params['fast_commit']
     push_option = module.params['push_option']
     mode = module.params['mode']
     key_file = module.params['key_file']
     ssh_opts = module.params['ssh_opts']
-    git_path = module.params['executable'] or module.get_bin_path('git', True)
+    git_path = module.params['executable'] or get_git_bin(module)
 
     if commit and not comment:
         module.fail_json(
             msg='Comment must be provided in order commit changes.'
         )
 
-    result = {}
+    add = add or []
+    if any(char in path for path in add for char in '*?['):
+        module.fail_json(
+            msg='Wildcard values are not accepted in add, list the files or directories to stage.'
+        )
+    # Drop repeated entries so git does not match the same pathspec twice.
+    add = list(dict.fromkeys(os.path.normpath(path) for path in add))
+
+    result = {
+        'local_path': local_path,
+        'changed': False,
+        'files': {}
+    }
 
     if module.params['accept_hostkey']:
         if ssh_opts is not None:
@@ -274,11 +392,6 @@ def main():
         else:
             ssh_opts = "-o StrictHostKeyChecking=no"
 
-            # We screenscrape a huge amount of git commands so use C locale anytime we
-            # call run_command()
-            module.run_command_environ_update = dict(LANG='C', LC_ALL='C', LC_MESSAGES='C',
-                                                     LC_CTYPE='C')
-
     gitconfig = None
     repo_path = os.path.realpath(local_path)
     try:
@@ -293,114 +406,182 @@ def main():
         )
     gitconfig = os.path.join(repo_path, 'config')
 
-    # create a wrapper script and export
-    # GIT_SSH=<path> as an environment variable
-    # for git to use the wrapper script
-    ssh_wrapper = write_ssh_wrapper()
-    set_git_ssh(ssh_wrapper, key_file, ssh_opts)
-    module.add_cleanup_file(path=ssh_wrapper)
-
-    git_version_used = git_version(git_path, module)
+    # create a wrapper script and pass
+    # GIT_SSH=<path> in the environment of every git
+    # command for git to use the wrapper script
+    ssh_wrapper, shared_wrapper = write_ssh_wrapper()
+    git_env = set_git_ssh(ssh_wrapper, key_file, ssh_opts)
+    if not shared_wrapper:
+        module.add_cleanup_file(path=ssh_wrapper)
+
+    # Probe the work tree once up front so that a clean tree that either is
+    # not pushed or is already in sync with <remote>/<branch> returns without
+    # running the add/commit/push chain.
+    (rc, out, err) = module.run_command(
+        # Explicit untracked/submodule modes keep the probe in agreement with
+        # git add regardless of status.* settings in the user's config.
+        [git_path, '-C', local_path, 'status', '--porcelain=v1', '--branch', '-z',
+         '--untracked-files=all', '--ignore-submodules=none'],
+        cwd=local_path,
+        environ_update=git_env,
+        encoding=None
+    )
+    if rc != 0:
+        module.fail_json(
+            msg="Failed to git_status: %s %s" % (to_text(out), to_text(err))
+        )
+    # The first record is the "## branch...upstream [ahead N]" header, every
+    # following record is a changed path.
+    header, _, entries = out.partition(b'\x00')
+    if not entries.strip(b'\x00'):
+        in_sync = not set_upstream and header == to_bytes('## {0}...{1}/{0}'.format(branch, remote))
+        if not push or in_sync:
+            module.exit_json(changed=False, local_path=local_path, files={})
 
     commands = list()
 
+    # With fast_commit an explicit list of files is staged and committed with
+    # plumbing commands, which update the index once and bypass the porcelain
+    # commit machinery (hooks, signing). Directories, "." included, still need
+    # git add to expand them.
+    use_plumbing = fast_commit and commit and add and not any(
+        os.path.isdir(os.path.join(local_path, path)) for path in add
+    )
+
     if add:
+        if use_plumbing:
+            # A dry-run git add fails on unmatched and ignored paths exactly
+            # like the real one, without writing the index.
+            add_command = '{} >/dev/null && {} | {}'.format(
+                shell_join([git_path, '-C', local_path, 'add', '--dry-run', '--', *add]),
+                shell_join(['printf', '%s\\0', *add]),
+                shell_join([git_path, '-C', local_path, 'update-index', '--add', '--remove', '-z', '--stdin'])
+            )
+        else:
+            add_command = shell_join([git_path, '-C', local_path, 'add', *add])
         commands.append((
             'git_add',
-            lambda *args, **kwargs: module.run_command(
-                "{} -C {} add {}".format(
-                    git_path,
-                    repo_path,
-                    ' '.join(add)
-                ),
-                cwd=local_path
-            )
+            add_command
         ))
         commands.append((
             'git_files_added',
-            lambda *args, **kwargs: module.run_command(
-                "{} -C {} diff-index --cached --name-status HEAD".format(
-                    git_path,
-                    repo_path
-                ),
-                cwd=local_path
-            )
+            shell_join([git_path, '-C', local_path, 'diff-index', '--cached', '--name-status', '-z', 'HEAD'])
         ))
 
-        def _get_diff_index(*args, **kwargs):
-            result.update({
-                'local_path': local_path,
-                'changed': False,
-                'files': {}
-            })
-
-            staged_files = [*args[:-1].split('\n')]
-            if len(staged_files) != 0:
-                changes = {
-                    'added': [],
-                    'modified': [],
-                    'deleted': []
-                }
-                for staged_file in staged_files:
-                    [stage_action, filename] = re.split(r'\s+', str(staged_file))
-                    if stage_action == 'A':
-                        stage_action = 'added'
-                    elif stage_action == 'D':
-                        stage_action = 'deleted'
-                    elif stage_action == 'M':
-                        stage_action = 'modified'
-                    else:
-                        continue
-                    changes[stage_action].append(filename)
-
+    def _get_diff_index(out):
+        # With -z every record is "<status>\0<path>\0"; paths are emitted
+        # verbatim instead of being quoted when they contain special characters.
+        if out:
+            changes = {
+                'added': [],
+                'modified': [],
+                'deleted': []
+            }
+            fields = iter(out.split(b'\x00'))
+            for stage_action, filename in zip(fields, fields):
+                bucket = ACTION_MAP.get(stage_action[:1])
+                if bucket is None:
+                    continue
+                changes[bucket].append(to_text(filename, errors='surrogate_or_replace'))
+
+            result['changed'] = True
+            result['files'] = changes
+
+    def _get_push_status(out):
+        # --porcelain prints "<flag>\t<from>:<to>\t<summary>" per ref, where
+        # "=" means the ref was already up to date.
+        for line in out.splitlines():
+            if b'\t' in line and not line.startswith(b'='):
                 result['changed'] = True
-                result['files'] = changes
-                return 0, '', ''
-            else:
-                module.exit_json(**result)
-
-        commands.append(('git_staged_files',
-                         _get_diff_index))
 
     if commit:
-        commands.append(
-            ('git_commit',
-             lambda *args, **kwargs: module.run_command(
-                 '{} -C {} commit -m "{}"'.format(
-                     git_path,
-                     repo_path,
-                     comment.replace("\"", r"\"", -1)
-                 ),
-                 cwd=local_path
-             )
-             ))
+        if use_plumbing:
+            # update-ref records the same reflog message as git commit and only
+            # moves HEAD if it still points at the parent the commit was built on.
+            commit_command = (
+                'parent=$({}) && tree=$({}) && commit=$({} "$tree" -p "$parent" -m {}) && '
+                '{} "$commit" "$parent"'
+            ).format(
+                shell_join([git_path, '-C', local_path, 'rev-parse', '--verify', 'HEAD']),
+                shell_join([git_path, '-C', local_path, 'write-tree']),
+                shell_join([git_path, '-C', local_path, 'commit-tree']),
+                quote(comment),
+                shell_join([
+                    git_path, '-C', local_path, 'update-ref',
+                    '-m', 'commit: {}'.format(comment.strip().partition('\n')[0]),
+                    'HEAD'
+                ])
+            )
+        else:
+            commit_command = shell_join([git_path, '-C', local_path, 'commit', '-m', comment])
+        if add:
+            # Only commit when something ended up staged; the push still runs
+            # so commits that are already local but not on the remote go out.
+            commit_command = '{{ {} || {}; }}'.format(
+                shell_join([git_path, '-C', local_path, 'diff-index', '--quiet', '--cached', 'HEAD']),
+                commit_command
+            )
+        commands.append((
+            'git_commit',
+            commit_command
+        ))
 
     if push:
-        push_option = "--push-option={}".format(push_option) if push_option else ""
-        commands.append(
-            ('git_push',
-             lambda *args, **kwargs: module.run_command(
-                 '{} -C {} push {} {} {} {}'.format(
-                     git_path,
-                     repo_path,
-                     push_option,
-                     remote,
-                     '--set-upstream ' if set_upstream else '',
-                     branch
-                 ),
-                 cwd=local_path
-             )
-             ))
-
-    prev_results = ()
-    for (label, command) in commands:
-        (rc, out, err) = command(*prev_results)
+        push_command = [git_path, '-C', local_path, 'push', '--porcelain']
+        if push_option:
+            push_command.append('--push-option={}'.format(push_option))
+        if set_upstream:
+            push_command.append('--set-upstream')
+        push_command += [remote, branch]
+        commands.append((
+            'git_push',
+            shell_join(push_command)
+        ))
+
+    if commands:
+        # Run every step in a single shell instead of forking git once per
+        # step. Each step announces itself on stdout with a sentinel so the
+        # combined output can be split back up per step, and so the last
+        # announced step is the one that failed. The sentinel carries a random
+        # per-run nonce, so no file name or git output can reproduce it.
+        sentinel = '{}{}_'.format(COMMAND_SEPARATOR, secrets.token_hex(16))
+        (rc, out, err) = module.run_command(
+            ' && '.join(
+                '{} && {}'.format(
+                    shell_join(['printf', '\\0%s\\n', sentinel + label]),
+                    command
+                )
+                for (label, command) in commands
+            ),
+            cwd=local_path,
+            use_unsafe_shell=True,
+            environ_update=git_env,
+            encoding=None
+        )
+
+        # Output stays bytes until it is placed into the result.
+        labels = set(label for (label, command) in commands)
+        separator = b'\x00' + to_bytes(sentinel)
+        outputs = {}
+        label = commands[0][0]
+        for chunk in out.split(separator)[1:]:
+            name, _, output = chunk.partition(b'\n')
+            name = to_text(name)
+            if name not in labels:
+                # Not one of our markers; keep it as output of the current step.
+                outputs[label] = outputs.get(label, b'') + separator + chunk
+                continue
+            label = name
+            outputs[label] = output
         if rc != 0:
             module.fail_json(
-                msg="Failed to %s: %s %s" % (label, out, err)
+                msg="Failed to %s: %s %s" % (label, to_text(outputs.get(label, out)), to_text(err))
             )
-        else:
-            prev_results = (rc, out, err)
+
+        if 'git_files_added' in outputs:
+            _get_diff_index(outputs['git_files_added'])
+        if 'git_push' in outputs:
+            _get_push_status(outputs['git_push'])
 
     module.exit_json(**result)
 